@@ -1,99 +1,195 @@
+import functools
+import hashlib
 import logging
-from typing import Dict, Any
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+from typing import Dict, Any, Callable, Optional, Tuple
+import pandas as pd
 from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.runnables import RunnableConfig
 from langchain_google_genai import ChatGoogleGenerativeAI
 
-from agent_state import EcommerceAnalysisState, ANALYSIS_TYPES, ECOMMERCE_TABLES
+from agent_state import EcommerceAnalysisState, AnalysisPlan, ANALYSIS_TYPES, ECOMMERCE_TABLES
 from bq_client import BigQueryRunner
 
 logger = logging.getLogger(__name__)
 
+LLM_CACHE_SIZE = 1024
+# A marker must be followed by a space, so markdown headings (**Key Insights:**)
+# and --- separators are not taken for insights
+INSIGHT_BULLETS = ('•', '- ', '* ')
+SCHEMA_TABLE_BUDGET = 400  # max characters of field listing per table in the LLM prompt
+MAX_ERRORS = 3
+RETRY_BACKOFF_SECONDS = 0.5  # doubled on every further retry
+
+# Matches any analysis type name, tolerating spaces for underscores and any
+# surrounding text or formatting the LLM adds (e.g. "Analysis type: `sales trends`")
+ANALYSIS_TYPE_RE = re.compile(
+    "|".join(re.escape(name).replace("_", "[_ ]") for name in ANALYSIS_TYPES.keys()),
+    re.IGNORECASE
+)
+
+# Prompt templates are built once at import; only the per-request values are
+# substituted at call time
+ANALYSIS_TYPE_NAMES = ", ".join(ANALYSIS_TYPES.keys())
+
+PLAN_PROMPT_TEMPLATE = """
+Plan a BigQuery SQL query for the following e-commerce analysis request:
+
+User Query: {user_query}
+
+Classify the request as one of these analysis types, or 'general' if unclear:
+{analysis_types}
+
+Available Tables and Schemas:
+{schema_context}
+
+SQL Requirements:
+- Use only SELECT statements
+- Include meaningful column aliases
+- Add appropriate WHERE clauses to filter data
+- Limit results to reasonable numbers (e.g., LIMIT 100 for detailed data)
+- Use proper JOIN syntax when needed
+- Focus on actionable business insights
+- Only use tables: orders, order_items, products, users from bigquery-public-data.thelook_ecommerce
+
+Return the analysis type and the SQL query without explanations.
+{retry_context}"""
+
+PLAN_RETRY_TEMPLATE = """
+A previous attempt failed. Fix the problem in the new SQL query.
+Previous SQL: {generated_sql}
+Error: {last_error}
+"""
+
+INSIGHTS_PROMPT_TEMPLATE = """
+Analyze the following BigQuery results and generate actionable business insights:
+
+Original Query: {user_query}
+Analysis Type: {analysis_type}
+SQL Query: {generated_sql}
+
+Query Results Summary:
+{results_summary}
+
+Generate 3-5 key business insights focusing on:
+- Trends and patterns identified
+- Business implications
+- Actionable recommendations
+- Data-driven conclusions
+
+Format as bullet points, each insight should be concise and actionable.
+"""
+
+
+def match_analysis_type(text: str) -> Optional[str]:
+    match = ANALYSIS_TYPE_RE.search(text)
+    return match.group(0).lower().replace(" ", "_") if match else None
+
+
+@functools.lru_cache(maxsize=8)
+def _format_schema_key(schema_key: Tuple[Tuple[str, Tuple[Tuple[str, str], ...]], ...]) -> str:
+    # One compact "name:TYPE" list per table, capped at a character budget,
+    # keeps the prompt small while still covering most columns
+    context = []
+    for table_name, fields in schema_key:
+        entries = []
+        used = 0
+        for name, field_type in fields:
+            entry = f"{name}:{field_type}"
+            if used + len(entry) > SCHEMA_TABLE_BUDGET:
+                break
+            entries.append(entry)
+            used += len(entry) + 2
+        context.append(f"{table_name.upper()} ({ECOMMERCE_TABLES.get(table_name, '')}): {', '.join(entries)}")
+    return '\n'.join(context)
+
 
 class EcommerceAgentNodes:
-    def __init__(self, bq_client: BigQueryRunner, llm: ChatGoogleGenerativeAI):
+    def __init__(self, bq_client: BigQueryRunner, llm: ChatGoogleGenerativeAI, cache_size: int = LLM_CACHE_SIZE):
         self.bq_client = bq_client
         self.llm = llm
+        self.planner = llm.with_structured_output(AnalysisPlan)
+        self._cache_size = cache_size
+        self._response_cache: "OrderedDict[str, Any]" = OrderedDict()
+        self._cache_lock = threading.Lock()
         
-    def understand_query_node(self, state: EcommerceAnalysisState) -> EcommerceAnalysisState:
-        user_message = state["messages"][-1].content if state["messages"] else ""
-        state["user_query"] = user_message
-        
-        analysis_prompt = f"""
-        Analyze this user query and determine the type of e-commerce analysis requested:
-        
-        Query: {user_message}
-        
-        Available analysis types:
-        {', '.join(ANALYSIS_TYPES.keys())}
-        
-        Return only the analysis type that best matches, or 'general' if unclear.
-        """
-        
-        try:
-            response = self.llm.invoke([HumanMessage(content=analysis_prompt)])
-            analysis_type = response.content.strip().lower()
-            
-            if analysis_type not in ANALYSIS_TYPES:
-                analysis_type = "general"
-                
-            state["analysis_type"] = analysis_type
-            logger.info(f"Identified analysis type: {analysis_type}")
-            
-        except Exception as e:
-            logger.error(f"Error in understand_query_node: {e}")
-            state["analysis_type"] = "general"
-            state["last_error"] = str(e)
-            state["error_count"] += 1
-            
-        return state
-    
-    def retrieve_schema_node(self, state: EcommerceAnalysisState) -> EcommerceAnalysisState:
+    def retrieve_schema_node(self, state: EcommerceAnalysisState) -> Dict[str, Any]:
         try:
             schemas = {}
+            missing = []
+            # Cached schemas are read directly; only the rest need a BigQuery call
             for table_name in ECOMMERCE_TABLES.keys():
-                try:
-                    schema_info = self.bq_client.get_table_schema(table_name)
-                    schemas[table_name] = schema_info
-                    logger.info(f"Retrieved schema for {table_name}")
-                except Exception as e:
-                    logger.warning(f"Could not retrieve schema for {table_name}: {e}")
+                cached = self.bq_client.get_cached_table_schema(table_name)
+                if cached is None:
+                    missing.append(table_name)
+                else:
+                    schemas[table_name] = cached
+            
+            # Schema lookups are independent blocking I/O, so fetch them concurrently
+            if missing:
+                with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+                    futures = {
+                        executor.submit(self.bq_client.get_table_schema, table_name): table_name
+                        for table_name in missing
+                    }
+                    for future in as_completed(futures):
+                        table_name = futures[future]
+                        try:
+                            schemas[table_name] = future.result()
+                            logger.info(f"Retrieved schema for {table_name}")
+                        except Exception as e:
+                            logger.warning(f"Could not retrieve schema for {table_name}: {e}")
+            
+            if not schemas:
+                raise RuntimeError("Could not retrieve any table schema")
                     
-            state["table_schemas"] = schemas
+            # Keep the table order stable regardless of completion order
+            table_schemas = {
+                table_name: schemas[table_name]
+                for table_name in ECOMMERCE_TABLES.keys() if table_name in schemas
+            }
+            return {
+                "table_schemas": table_schemas,
+                # Formatted once here so planning retries reuse it
+                "schema_context": self._format_schema_context(table_schemas),
+                "last_error": None,
+                "last_failed_node": None
+            }
             
         except Exception as e:
             logger.error(f"Error in retrieve_schema_node: {e}")
-            state["last_error"] = str(e)
-            state["error_count"] += 1
-            
-        return state
+            return {"last_error": str(e), "last_failed_node": "retrieve_schema", "error_count": 1}
     
-    def generate_sql_node(self, state: EcommerceAnalysisState) -> EcommerceAnalysisState:
+    def plan_query_node(self, state: EcommerceAnalysisState) -> Dict[str, Any]:
+        # Classify the request and generate its SQL in a single structured LLM call
         try:
-            schema_context = self._format_schema_context(state["table_schemas"])
-            
-            sql_prompt = f"""
-            Generate a BigQuery SQL query for the following e-commerce analysis request:
-            
-            User Query: {state["user_query"]}
-            Analysis Type: {state["analysis_type"]}
-            
-            Available Tables and Schemas:
-            {schema_context}
-            
-            Requirements:
-            - Use only SELECT statements
-            - Include meaningful column aliases
-            - Add appropriate WHERE clauses to filter data
-            - Limit results to reasonable numbers (e.g., LIMIT 100 for detailed data)
-            - Use proper JOIN syntax when needed
-            - Focus on actionable business insights
-            - Only use tables: orders, order_items, products, users from bigquery-public-data.thelook_ecommerce
-            
-            Return only the SQL query without explanations.
-            """
+            # On a retry, show the model what went wrong; this also keeps the
+            # retry from being answered with the cached failing plan
+            retry_context = ""
+            if state.get("last_error") and state.get("last_failed_node") in ("plan_query", "execute_query"):
+                retry_context = PLAN_RETRY_TEMPLATE.format(
+                    generated_sql=state.get("generated_sql") or "(none)",
+                    last_error=state["last_error"]
+                )
+            
+            plan_prompt = PLAN_PROMPT_TEMPLATE.format(
+                user_query=state["user_query"],
+                analysis_types=ANALYSIS_TYPE_NAMES,
+                schema_context=state["schema_context"],
+                retry_context=retry_context
+            )
+            
+            plan, plan_cache_key = self._cached_plan(plan_prompt)
+            
+            analysis_type = match_analysis_type(plan.analysis_type) or "general"
+            logger.info(f"Identified analysis type: {analysis_type}")
             
-            response = self.llm.invoke([HumanMessage(content=sql_prompt)])
-            sql_query = response.content.strip()
+            sql_query = plan.sql.strip()
             
             # Clean up the SQL query
             if sql_query.startswith("```sql"):
@@ -101,127 +197,192 @@ class EcommerceAgentNodes:
             if sql_query.endswith("```"):
                 sql_query = sql_query[:-3]
                 
-            state["generated_sql"] = sql_query.strip()
             logger.info("Generated SQL query successfully")
+            return {
+                "analysis_type": analysis_type,
+                "generated_sql": sql_query.strip(),
+                # Kept so execute_query can evict the plan if its SQL fails
+                "plan_cache_key": plan_cache_key,
+                "last_error": None,
+                "last_failed_node": None
+            }
             
         except Exception as e:
-            logger.error(f"Error in generate_sql_node: {e}")
-            state["last_error"] = str(e)
-            state["error_count"] += 1
-            
-        return state
+            logger.error(f"Error in plan_query_node: {e}")
+            return {
+                "analysis_type": state.get("analysis_type") or "general",
+                "last_error": str(e),
+                "last_failed_node": "plan_query",
+                "error_count": 1
+            }
     
-    def execute_query_node(self, state: EcommerceAnalysisState) -> EcommerceAnalysisState:
+    def execute_query_node(self, state: EcommerceAnalysisState) -> Dict[str, Any]:
         try:
             if not state["generated_sql"]:
                 raise ValueError("No SQL query to execute")
                 
             df = self.bq_client.execute_query(state["generated_sql"])
             
-            # Convert results to a serializable format
+            # Convert results to a serializable format, reading only the first 50 rows
+            columns = df.columns.tolist()
+            rows = islice(df.itertuples(index=False, name=None), 50)
             query_results = {
                 "row_count": len(df),
-                "columns": df.columns.tolist(),
-                "data": df.to_dict('records')[:50],  # Limit to first 50 rows
+                "columns": columns,
+                "data": [dict(zip(columns, row)) for row in rows],
                 "summary_stats": {}
             }
             
-            # Add basic summary statistics for numeric columns
-            numeric_columns = df.select_dtypes(include=['number']).columns
-            for col in numeric_columns:
-                if not df[col].empty:
-                    query_results["summary_stats"][col] = {
-                        "mean": float(df[col].mean()) if not df[col].isna().all() else None,
-                        "min": float(df[col].min()) if not df[col].isna().all() else None,
-                        "max": float(df[col].max()) if not df[col].isna().all() else None
+            # Add basic summary statistics for numeric columns; pandas reductions
+            # skip nulls and work on Arrow-backed columns without a dense copy
+            numeric_df = df.select_dtypes(include=['number'])
+            if not numeric_df.empty:
+                stats_df = numeric_df.agg(['mean', 'min', 'max'])
+                query_results["summary_stats"] = {
+                    col: {
+                        # All-null columns reduce to NA, which is reported as None
+                        stat: float(value) if pd.notna(value) else None
+                        for stat, value in stats_df[col].items()
                     }
+                    for col in stats_df.columns
+                }
             
-            state["query_results"] = query_results
             logger.info(f"Query executed successfully, returned {len(df)} rows")
+            return {"query_results": query_results, "last_error": None, "last_failed_node": None}
             
         except Exception as e:
             logger.error(f"Error in execute_query_node: {e}")
-            state["last_error"] = str(e)
-            state["error_count"] += 1
-            
-        return state
+            # A plan whose SQL fails must not be served to later runs of the same question
+            if state.get("plan_cache_key"):
+                self._cache_evict(state["plan_cache_key"])
+            return {"last_error": str(e), "last_failed_node": "execute_query", "error_count": 1}
     
-    def generate_insights_node(self, state: EcommerceAnalysisState) -> EcommerceAnalysisState:
+    def generate_insights_node(self, state: EcommerceAnalysisState, config: RunnableConfig = None) -> Dict[str, Any]:
+        # Optional per-run callback receiving each insight bullet as soon as it is streamed
+        on_insight = (config or {}).get("configurable", {}).get("on_insight")
+        
+        def emit(line: str) -> None:
+            line = line.strip()
+            if on_insight and line.startswith(INSIGHT_BULLETS):
+                on_insight(line)
+        
         try:
             if not state["query_results"]:
                 raise ValueError("No query results to analyze")
                 
             results_summary = self._format_results_summary(state["query_results"])
             
-            insights_prompt = f"""
-            Analyze the following BigQuery results and generate actionable business insights:
-            
-            Original Query: {state["user_query"]}
-            Analysis Type: {state["analysis_type"]}
-            SQL Query: {state["generated_sql"]}
-            
-            Query Results Summary:
-            {results_summary}
-            
-            Generate 3-5 key business insights focusing on:
-            - Trends and patterns identified
-            - Business implications
-            - Actionable recommendations
-            - Data-driven conclusions
+            insights_prompt = INSIGHTS_PROMPT_TEMPLATE.format(
+                user_query=state["user_query"],
+                analysis_type=state["analysis_type"],
+                generated_sql=state["generated_sql"],
+                results_summary=results_summary
+            )
             
-            Format as bullet points, each insight should be concise and actionable.
-            """
-            
-            response = self.llm.invoke([HumanMessage(content=insights_prompt)])
-            insights_text = response.content.strip()
+            insights_text = self._cached_stream(insights_prompt, emit).strip()
             
             # Parse insights into list
-            insights = [line.strip() for line in insights_text.split('\n') 
-                       if line.strip() and (line.strip().startswith('•') or line.strip().startswith('-'))]
+            insights = [line for line in (ln.strip() for ln in insights_text.splitlines())
+                        if line.startswith(INSIGHT_BULLETS)]
             
             if not insights:
                 insights = [insights_text]
                 
-            state["insights"] = insights
-            state["completed"] = True
-            
-            # Add AI response to messages
-            state["messages"].append(AIMessage(content=f"Analysis completed. Generated insights: {'; '.join(insights)}"))
-            
             logger.info(f"Generated {len(insights)} insights")
             
+            return {
+                "insights": insights,
+                "completed": True,
+                "last_error": None,
+                "last_failed_node": None,
+                # Add AI response to messages
+                "messages": [AIMessage(content=f"Analysis completed. Generated insights: {'; '.join(insights)}")]
+            }
+            
         except Exception as e:
             logger.error(f"Error in generate_insights_node: {e}")
-            state["last_error"] = str(e)
-            state["error_count"] += 1
-            
-        return state
+            return {"last_error": str(e), "last_failed_node": "generate_insights", "error_count": 1}
     
-    def error_handler_node(self, state: EcommerceAnalysisState) -> EcommerceAnalysisState:
+    def error_handler_node(self, state: EcommerceAnalysisState) -> Dict[str, Any]:
         error_msg = f"Error occurred: {state.get('last_error', 'Unknown error')}"
         
-        if state["error_count"] >= 3:
+        if state["error_count"] >= MAX_ERRORS:
             final_error = "Maximum retry attempts reached. Unable to complete analysis."
-            state["messages"].append(AIMessage(content=final_error))
-            state["completed"] = True
             logger.error(final_error)
-        else:
-            retry_msg = f"Attempting to retry analysis. Error count: {state['error_count']}"
-            logger.info("Attempt: " + str(state["error_count"]) + " " + error_msg)
-            state["messages"].append(AIMessage(content=retry_msg))
-            logger.info(retry_msg)
-            
-        return state
+            return {"messages": [AIMessage(content=final_error)], "completed": True}
+        
+        retry_msg = f"Attempting to retry analysis. Error count: {state['error_count']}"
+        logger.info("Attempt: " + str(state["error_count"]) + " " + error_msg)
+        logger.info(retry_msg)
+        
+        # Exponential backoff so transient failures (e.g. Gemini 429s) can clear
+        time.sleep(RETRY_BACKOFF_SECONDS * 2 ** (state["error_count"] - 1))
+        return {"messages": [AIMessage(content=retry_msg)]}
+    
+    def _cached_plan(self, prompt: str) -> Tuple[AnalysisPlan, str]:
+        key = self._cache_key(prompt)
+        plan = self._cache_lookup(key)
+        if plan is None:
+            plan = self.planner.invoke([HumanMessage(content=prompt)])
+            self._cache_store(key, plan)
+        return plan, key
+    
+    def _cached_stream(self, prompt: str, on_line: Optional[Callable[[str], None]] = None) -> str:
+        key = self._cache_key(prompt)
+        content = self._cache_lookup(key)
+        if content is not None:
+            if on_line:
+                for line in content.splitlines():
+                    on_line(line)
+            return content
+        
+        parts = []
+        pending = ""
+        for chunk in self.llm.stream([HumanMessage(content=prompt)]):
+            parts.append(chunk.content)
+            pending += chunk.content
+            # Hand over every line as soon as it is complete
+            while "\n" in pending:
+                line, pending = pending.split("\n", 1)
+                if on_line:
+                    on_line(line)
+        if pending and on_line:
+            on_line(pending)
+        
+        content = "".join(parts)
+        self._cache_store(key, content)
+        return content
+    
+    def _cache_key(self, prompt: str) -> str:
+        # Prompts embed every input the answer depends on (query, analysis type,
+        # schema, results), so the prompt text itself is the cache key.
+        return hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()
+    
+    def _cache_lookup(self, key: str) -> Optional[Any]:
+        with self._cache_lock:
+            if key not in self._response_cache:
+                return None
+            self._response_cache.move_to_end(key)
+            logger.info("LLM response served from cache")
+            return self._response_cache[key]
+    
+    def _cache_store(self, key: str, content: Any) -> None:
+        with self._cache_lock:
+            self._response_cache[key] = content
+            if len(self._response_cache) > self._cache_size:
+                self._response_cache.popitem(last=False)
+    
+    def _cache_evict(self, key: str) -> None:
+        with self._cache_lock:
+            self._response_cache.pop(key, None)
     
     def _format_schema_context(self, schemas: Dict[str, Any]) -> str:
-        context = []
-        for table_name, schema_info in schemas.items():
-            if schema_info:
-                context.append(f"\n{table_name.upper()} table:")
-                context.append(f"Description: {ECOMMERCE_TABLES.get(table_name, '')}")
-                for field in schema_info[:10]:  # Limit to first 10 fields
-                    context.append(f"  - {field['name']} ({field['type']}): {field.get('description', '')}")
-        return '\n'.join(context)
+        # Schemas rarely change, so the text is memoized on their (name, type) content
+        schema_key = tuple(
+            (table_name, tuple((field['name'], field['type']) for field in schema_info))
+            for table_name, schema_info in schemas.items() if schema_info
+        )
+        return _format_schema_key(schema_key)
     
     def _format_results_summary(self, results: Dict[str, Any]) -> str:
         summary = [
@@ -1,17 +1,25 @@
-from typing import TypedDict, List, Dict, Any, Optional
+import operator
+from typing import TypedDict, List, Dict, Any, Optional, Annotated
 from langchain_core.messages import BaseMessage
+from langgraph.graph.message import add_messages
+from pydantic import BaseModel, Field
 
 
+# Nodes return partial updates. Two keys carry a reducer: messages are
+# appended, and error_count sums the increments returned by failing nodes.
 class EcommerceAnalysisState(TypedDict):
-    messages: List[BaseMessage]
+    messages: Annotated[List[BaseMessage], add_messages]
     user_query: str
     analysis_type: Optional[str]
     table_schemas: Dict[str, List[Dict[str, Any]]]
+    schema_context: str
     generated_sql: str
+    plan_cache_key: Optional[str]
     query_results: Optional[Dict[str, Any]]
     insights: List[str]
-    error_count: int
+    error_count: Annotated[int, operator.add]
     last_error: Optional[str]
+    last_failed_node: Optional[str]
     completed: bool
 
 
@@ -28,4 +36,10 @@ ANALYSIS_TYPES = {
     "sales_trends": "Sales trends and seasonality patterns",
     "geographic_patterns": "Geographic sales patterns and regional analysis",
     "general": "General data analysis and insights"
-}
\ No newline at end of file
+}
+
+
+class AnalysisPlan(BaseModel):
+    """Structured LLM output combining query classification and SQL generation."""
+    analysis_type: str = Field(description="Analysis type: " + ", ".join(ANALYSIS_TYPES.keys()))
+    sql: str = Field(description="BigQuery SQL query answering the request")
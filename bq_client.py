@@ -1,23 +1,77 @@
 import logging
-from typing import Optional, List, Dict, Any
+import threading
+import time
+from typing import Optional, List, Dict, Any, Tuple
+import google.auth
 import pandas as pd
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import bigquery
+from google.cloud import bigquery_storage
+from requests.adapters import HTTPAdapter
+
+HTTP_POOL_SIZE = 20
+
+# INFORMATION_SCHEMA reports standard SQL type names; SchemaField.field_type
+# uses the legacy names for these
+_LEGACY_FIELD_TYPES = {
+    "INT64": "INTEGER",
+    "FLOAT64": "FLOAT",
+    "BOOL": "BOOLEAN",
+    "STRUCT": "RECORD",
+}
+
+_http_session: Optional[AuthorizedSession] = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session() -> AuthorizedSession:
+    """Return the process-wide authorized HTTP session shared by all BigQuery clients.
+    
+    The session mounts a pooled adapter so connections stay warm and concurrent
+    requests reuse sockets instead of each paying a new TLS handshake.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            credentials, _ = google.auth.default(scopes=bigquery.Client.SCOPE)
+            session = AuthorizedSession(credentials)
+            session.mount("https://", HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+            _http_session = session
+    return _http_session
+
+
+def _to_field_type(data_type: str) -> Tuple[str, bool]:
+    """Map an INFORMATION_SCHEMA data_type to (SchemaField.field_type, is_repeated)."""
+    repeated = data_type.startswith("ARRAY<")
+    if repeated:
+        data_type = data_type[len("ARRAY<"):-1]
+    # Drop type parameters such as STRING(10), NUMERIC(10, 2) or STRUCT<...>
+    base_type = data_type.split("<", 1)[0].split("(", 1)[0].strip().upper()
+    return _LEGACY_FIELD_TYPES.get(base_type, base_type), repeated
 
 
 class BigQueryRunner:
     """A lean BigQuery client for executing SQL queries and returning DataFrame results."""
     
-    def __init__(self, project_id: Optional[str] = None, dataset_id: Optional[str] = "bigquery-public-data.thelook_ecommerce") -> None:
+    def __init__(self, project_id: Optional[str] = None, dataset_id: Optional[str] = "bigquery-public-data.thelook_ecommerce", schema_ttl: float = 3600.0) -> None:
         """Initialize BigQuery client.
         
         Args:
             project_id: Google Cloud project ID. If None, uses default credentials.
             dataset_id: BigQuery dataset ID. If None, uses default dataset.
+            schema_ttl: Seconds a fetched table schema is reused before refetching.
         """
         logging.info("Initializing BigQuery client")
         try:
-            self.client = bigquery.Client(project=project_id)
+            http_session = get_http_session()
+            self.client = bigquery.Client(project=project_id, credentials=http_session.credentials, _http=http_session)
+            # Storage Read API client for Arrow-based result downloads
+            self.bqstorage_client = bigquery_storage.BigQueryReadClient(credentials=http_session.credentials)
             self.dataset_id = dataset_id
+            self.schema_ttl = schema_ttl
+            self._schema_cache: Dict[str, Tuple[float, List[Dict[str, Any]]]] = {}
+            self._dataset_schema: Optional[Tuple[float, Dict[str, List[Dict[str, Any]]]]] = None
+            self._schema_lock = threading.Lock()
             logging.info(f"BigQuery client initialized for dataset: {self.dataset_id}")
         except Exception as e:
             logging.error(f"Failed to initialize BigQuery client: {str(e)}")
@@ -26,6 +80,10 @@ class BigQueryRunner:
     def execute_query(self, sql_query: str) -> pd.DataFrame:
         """Execute a SQL query and return results as a DataFrame.
         
+        Results are downloaded as Arrow record batches through the BigQuery
+        Storage API and kept Arrow-backed (``pd.ArrowDtype`` columns), which
+        avoids decoding JSON rows one by one in Python.
+        
         Args:
             sql_query: The SQL query to execute.
             
@@ -38,24 +96,44 @@ class BigQueryRunner:
         try:
             logging.info(f"Executing BigQuery query")
             query_job = self.client.query(sql_query)
-            df = query_job.result().to_dataframe()
+            arrow_table = query_job.result().to_arrow(bqstorage_client=self.bqstorage_client)
+            df = arrow_table.to_pandas(types_mapper=pd.ArrowDtype)
             logging.info(f"Query completed successfully, returned {len(df)} rows")
             return df
         except Exception as e:
             logging.error(f"BigQuery execution failed: {str(e)}")
             raise 
 
+    def get_cached_table_schema(self, table_name: str) -> Optional[List[Dict[str, Any]]]:
+        """Return the cached schema for a table, or None if it is missing or expired.
+        
+        Never calls BigQuery, so callers can skip scheduling work for tables
+        that are already cached.
+        """
+        with self._schema_lock:
+            cached = self._schema_cache.get(f"{self.dataset_id}.{table_name}")
+        if cached and time.monotonic() - cached[0] < self.schema_ttl:
+            return cached[1]
+        return None
+
     def get_table_schema(self, table_name: str) -> List[Dict[str, Any]]:
         """Get schema information for a specific table.
         
+        Schemas are cached per table for ``schema_ttl`` seconds, so repeated
+        analyses only hit BigQuery once per table.
+        
         Args:
             table_name: Name of the table (orders, order_items, products, users).
             
         Returns:
             List of dictionaries containing column information.
         """
+        cached = self.get_cached_table_schema(table_name)
+        if cached is not None:
+            return cached
+        
+        table_ref = f"{self.dataset_id}.{table_name}"
         try:
-            table_ref = f"{self.dataset_id}.{table_name}"
             table = self.client.get_table(table_ref)
             schema_info = []
             for field in table.schema:
@@ -65,8 +143,63 @@ class BigQueryRunner:
                     "mode": field.mode,
                     "description": field.description or ""
                 })
+            with self._schema_lock:
+                self._schema_cache[table_ref] = (time.monotonic(), schema_info)
             logging.info(f"Retrieved schema for table {table_name}")
             return schema_info
         except Exception as e:
             logging.error(f"Failed to get schema for table {table_name}: {str(e)}")
-            raise        
\ No newline at end of file
+            raise
+
+    def get_dataset_schema(self) -> Dict[str, List[Dict[str, Any]]]:
+        """Get schema information for every table in the dataset with a single query.
+        
+        Reads the dataset's INFORMATION_SCHEMA views instead of issuing one
+        get_table call per table. Column types and descriptions are reported the
+        same way as get_table_schema, so the result also fills the per-table
+        schema cache.
+        
+        Returns:
+            Dictionary mapping table names to lists of column information.
+        """
+        with self._schema_lock:
+            cached = self._dataset_schema
+        if cached and time.monotonic() - cached[0] < self.schema_ttl:
+            return cached[1]
+        
+        try:
+            # Column descriptions live in COLUMN_FIELD_PATHS, on the path that
+            # names the top-level column itself
+            sql_query = f"""
+                SELECT c.table_name, c.column_name, c.data_type, c.is_nullable, p.description
+                FROM `{self.dataset_id}`.INFORMATION_SCHEMA.COLUMNS AS c
+                LEFT JOIN `{self.dataset_id}`.INFORMATION_SCHEMA.COLUMN_FIELD_PATHS AS p
+                    ON p.table_name = c.table_name
+                    AND p.column_name = c.column_name
+                    AND p.field_path = c.column_name
+                ORDER BY c.table_name, c.ordinal_position
+            """
+            schemas: Dict[str, List[Dict[str, Any]]] = {}
+            for row in self.client.query(sql_query).result():
+                field_type, repeated = _to_field_type(row.data_type)
+                if repeated:
+                    mode = "REPEATED"
+                else:
+                    mode = "NULLABLE" if row.is_nullable == "YES" else "REQUIRED"
+                schemas.setdefault(row.table_name, []).append({
+                    "name": row.column_name,
+                    "type": field_type,
+                    "mode": mode,
+                    "description": row.description or ""
+                })
+            
+            fetched_at = time.monotonic()
+            with self._schema_lock:
+                self._dataset_schema = (fetched_at, schemas)
+                for table_name, schema_info in schemas.items():
+                    self._schema_cache[f"{self.dataset_id}.{table_name}"] = (fetched_at, schema_info)
+            logging.info(f"Retrieved schema for {len(schemas)} tables in {self.dataset_id}")
+            return schemas
+        except Exception as e:
+            logging.error(f"Failed to get schema for dataset {self.dataset_id}: {str(e)}")
+            raise
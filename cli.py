@@ -1,17 +1,20 @@
 #!/usr/bin/env python3
 
 import os
+import asyncio
 import logging
 import click
-from rich.console import Console
+from rich.console import Console, Group
+from rich.live import Live
 from rich.panel import Panel
+from rich.spinner import Spinner
 from rich.syntax import Syntax
 from rich.table import Table
 from rich.text import Text
 from rich.markdown import Markdown
 from dotenv import load_dotenv
 
-from ecommerce_agent import EcommerceAnalysisAgent
+from ecommerce_agent import EcommerceAnalysisAgent, retry_node_for
 
 # Load environment variables
 load_dotenv()
@@ -24,6 +27,14 @@ logging.basicConfig(
 
 console = Console()
 
+# Graph nodes shown in the live progress checklist, in execution order
+PIPELINE_STAGES = [
+    ("retrieve_schema", "Retrieving table schemas"),
+    ("plan_query", "Understanding the question and generating SQL"),
+    ("execute_query", "Running the query on BigQuery"),
+    ("generate_insights", "Generating business insights"),
+]
+
 
 class EcommerceCLI:
     def __init__(self):
@@ -70,6 +81,66 @@ class EcommerceCLI:
         
         console.print(Panel(Markdown(welcome_text), title="Welcome", border_style="blue"))
     
+    def analyze_with_progress(self, user_query, status_text="Analyzing your request..."):
+        return asyncio.run(self._analyze_with_progress(user_query, status_text))
+    
+    async def _analyze_with_progress(self, user_query, status_text):
+        done = set()
+        progress = {"sql": None, "insights": [], "retry": None}
+        
+        def render():
+            checklist = Table.grid(padding=(0, 1))
+            pending_marked = False
+            for stage, label in PIPELINE_STAGES:
+                if stage in done:
+                    checklist.add_row(Text("✓", style="green"), Text(label))
+                elif not pending_marked:
+                    checklist.add_row(Spinner("dots", style="green"), Text(label, style="bold"))
+                    pending_marked = True
+                else:
+                    checklist.add_row(Text("·", style="dim"), Text(label, style="dim"))
+            
+            parts = [Panel(checklist, title=status_text, border_style="green")]
+            if progress["retry"]:
+                parts.append(Text(progress["retry"], style="yellow"))
+            if progress["sql"]:
+                parts.append(Panel(Syntax(progress["sql"], "sql", theme="monokai"), title="Generated SQL", border_style="cyan"))
+            if progress["insights"]:
+                parts.append(Panel("\n".join(progress["insights"]), title="Business Insights", border_style="magenta"))
+            return Group(*parts)
+        
+        result = None
+        failure = None
+        with Live(render(), console=console, refresh_per_second=10, transient=True) as live:
+            def on_insight(insight):
+                progress["insights"].append(insight)
+                live.update(render())
+            
+            async for node_name, update in self.agent.astream_analyze(user_query, on_insight=on_insight):
+                if node_name == "result":
+                    result = update
+                elif update.get("last_error"):
+                    # Only remembered here; error_handler decides whether to retry
+                    failure = (node_name, update["last_error"])
+                elif node_name == "error_handler":
+                    if failure and not update.get("completed"):
+                        failed_node, error = failure
+                        # The retry restarts from the stage the error handler routes to
+                        restart = retry_node_for(failed_node)
+                        stage_names = [stage for stage, _ in PIPELINE_STAGES]
+                        done.difference_update(stage_names[stage_names.index(restart):])
+                        if restart != "generate_insights":
+                            progress["sql"] = None
+                        progress["insights"] = []
+                        progress["retry"] = f"Retrying after error in {failed_node}: {error}"
+                elif node_name in dict(PIPELINE_STAGES):
+                    done.add(node_name)
+                    if update.get("generated_sql"):
+                        progress["sql"] = update["generated_sql"]
+                live.update(render())
+        
+        return result
+    
     def display_result(self, result):
         if not result.get("success"):
             console.print(f"[red]Analysis failed: {result.get('error', 'Unknown error')}[/red]")
@@ -188,9 +259,8 @@ class EcommerceCLI:
                 elif not user_input.strip():
                     continue
                 
-                # Process the analysis request
-                with console.status("[bold green]Analyzing your request..."):
-                    result = self.agent.analyze(user_input)
+                # Process the analysis request, streaming insights as they arrive
+                result = self.analyze_with_progress(user_input)
                 
                 self.display_result(result)
                 
@@ -204,21 +274,33 @@ class EcommerceCLI:
 
 @click.command()
 @click.option('--query', '-q', help='Single query to analyze')
+@click.option('--queries-file', '-f', type=click.File('r'), help='File with one query per line to analyze concurrently')
 @click.option('--schema', '-s', help='Show schema for specific table')
 @click.option('--interactive/--no-interactive', default=True, help='Run in interactive mode')
-def main(query, schema, interactive):
+def main(query, queries_file, schema, interactive):
     cli = EcommerceCLI()
     
     if schema:
         cli.display_schema(schema)
         return
     
+    if queries_file:
+        if not cli.agent:
+            return
+        
+        queries = [line.strip() for line in queries_file if line.strip()]
+        with console.status(f"[bold green]Analyzing {len(queries)} queries..."):
+            results = asyncio.run(cli.agent.analyze_many(queries))
+        
+        for result in results:
+            cli.display_result(result)
+        return
+    
     if query:
         if not cli.agent:
             return
         
-        with console.status("[bold green]Analyzing your query..."):
-            result = cli.agent.analyze(query)
+        result = cli.analyze_with_progress(query, "Analyzing your query...")
         
         cli.display_result(result)
         return
@@ -1,27 +1,55 @@
+import asyncio
+import functools
 import logging
-from typing import Dict, Any
-from langgraph.graph import StateGraph, END
+from typing import Dict, Any, AsyncIterator, Callable, List, Optional, Tuple
+from langgraph.graph import StateGraph, START, END
 from langchain_core.messages import HumanMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
 
-from agent_state import EcommerceAnalysisState
-from agent_nodes import EcommerceAgentNodes
+from agent_state import EcommerceAnalysisState, ECOMMERCE_TABLES
+from agent_nodes import EcommerceAgentNodes, MAX_ERRORS
 from bq_client import BigQueryRunner
 
 logger = logging.getLogger(__name__)
 
+# Node the graph retries after each kind of failure; planning and execution
+# failures both need a new SQL query
+RETRY_NODES = {
+    "retrieve_schema": "retrieve_schema",
+    "plan_query": "plan_query",
+    "execute_query": "plan_query",
+    "generate_insights": "generate_insights",
+}
+
+
+def retry_node_for(failed_node: Optional[str]) -> str:
+    """Return the node error_handler routes back to after ``failed_node`` failed."""
+    return RETRY_NODES.get(failed_node, "plan_query")
+
+
+# Clients are shared by every agent built with the same settings, so new
+# agents reuse warm connections and credentials instead of re-initializing them
+@functools.lru_cache(maxsize=4)
+def _get_llm(google_api_key: str, model: str = "gemini-1.5-pro", temperature: float = 0.1) -> ChatGoogleGenerativeAI:
+    return ChatGoogleGenerativeAI(
+        model=model,
+        google_api_key=google_api_key,
+        temperature=temperature
+    )
+
+
+@functools.lru_cache(maxsize=4)
+def _get_bq_client(project_id: Optional[str] = None) -> BigQueryRunner:
+    return BigQueryRunner(project_id=project_id)
+
 
 class EcommerceAnalysisAgent:
     def __init__(self, google_api_key: str, project_id: str = None):
         # Initialize LLM
-        self.llm = ChatGoogleGenerativeAI(
-            model="gemini-1.5-pro",
-            google_api_key=google_api_key,
-            temperature=0.1
-        )
+        self.llm = _get_llm(google_api_key)
         
         # Initialize BigQuery client
-        self.bq_client = BigQueryRunner(project_id=project_id)
+        self.bq_client = _get_bq_client(project_id)
         
         # Initialize agent nodes
         self.nodes = EcommerceAgentNodes(self.bq_client, self.llm)
@@ -33,23 +61,29 @@ class EcommerceAnalysisAgent:
         workflow = StateGraph(EcommerceAnalysisState)
         
         # Add nodes
-        workflow.add_node("understand_query", self.nodes.understand_query_node)
         workflow.add_node("retrieve_schema", self.nodes.retrieve_schema_node)
-        workflow.add_node("generate_sql", self.nodes.generate_sql_node)
+        workflow.add_node("plan_query", self.nodes.plan_query_node)
         workflow.add_node("execute_query", self.nodes.execute_query_node)
         workflow.add_node("generate_insights", self.nodes.generate_insights_node)
         workflow.add_node("error_handler", self.nodes.error_handler_node)
         
-        # Define the workflow edges
-        workflow.set_entry_point("understand_query")
+        # Schema retrieval feeds the single LLM call that classifies the
+        # request and generates its SQL
+        workflow.add_edge(START, "retrieve_schema")
         
-        # Linear flow with error handling
-        workflow.add_edge("understand_query", "retrieve_schema")
-        workflow.add_edge("retrieve_schema", "generate_sql")
+        # Conditional edge from retrieve_schema
+        workflow.add_conditional_edges(
+            "retrieve_schema",
+            self._should_plan_query,
+            {
+                "plan": "plan_query",
+                "error": "error_handler"
+            }
+        )
         
-        # Conditional edge from generate_sql
+        # Conditional edge from plan_query
         workflow.add_conditional_edges(
-            "generate_sql",
+            "plan_query",
             self._should_execute_query,
             {
                 "execute": "execute_query",
@@ -67,21 +101,30 @@ class EcommerceAnalysisAgent:
             }
         )
         
-        # Conditional edge from error_handler
+        # Conditional edge from error_handler: retry the stage that failed
         workflow.add_conditional_edges(
             "error_handler",
             self._should_retry_or_end,
-            {
-                "retry": "generate_sql",
-                "end": END
-            }
+            {**{node: node for node in RETRY_NODES.values()}, "end": END}
         )
         
         # End the workflow after generating insights
-        workflow.add_edge("generate_insights", END)
+        workflow.add_conditional_edges(
+            "generate_insights",
+            self._should_end,
+            {
+                "end": END,
+                "error": "error_handler"
+            }
+        )
         
         return workflow.compile()
     
+    def _should_plan_query(self, state: EcommerceAnalysisState) -> str:
+        if state.get("last_error") or not state.get("table_schemas"):
+            return "error"
+        return "plan"
+    
     def _should_execute_query(self, state: EcommerceAnalysisState) -> str:
         if state.get("last_error") or not state.get("generated_sql"):
             return "error"
@@ -92,47 +135,118 @@ class EcommerceAnalysisAgent:
             return "error" 
         return "insights"
     
+    def _should_end(self, state: EcommerceAnalysisState) -> str:
+        if state.get("last_error") or not state.get("insights"):
+            return "error"
+        return "end"
+    
     def _should_retry_or_end(self, state: EcommerceAnalysisState) -> str:
-        if state["error_count"] >= 3 or state.get("completed", False):
+        if state["error_count"] >= MAX_ERRORS or state.get("completed", False):
             return "end"
-        return "retry"
+        return retry_node_for(state.get("last_failed_node"))
     
-    def analyze(self, user_query: str) -> Dict[str, Any]:
-        initial_state = EcommerceAnalysisState(
+    def analyze(self, user_query: str, on_insight: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+        try:
+            final_state = self.app.invoke(
+                self._initial_state(user_query),
+                config={"configurable": {"on_insight": on_insight}}
+            )
+            return self._build_result(final_state)
+            
+        except Exception as e:
+            return self._error_result(user_query, e)
+    
+    async def a_analyze(self, user_query: str, on_insight: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+        # Blocking nodes (Gemini, BigQuery) are run in worker threads by LangGraph,
+        # so several analyses can be awaited concurrently
+        try:
+            final_state = await self.app.ainvoke(
+                self._initial_state(user_query),
+                config={"configurable": {"on_insight": on_insight}}
+            )
+            return self._build_result(final_state)
+            
+        except Exception as e:
+            return self._error_result(user_query, e)
+    
+    async def astream_analyze(self, user_query: str, on_insight: Optional[Callable[[str], None]] = None) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+        """Yield (node_name, update) as each graph node completes, then ("result", result)."""
+        try:
+            initial_state = self._initial_state(user_query)
+            final_state = initial_state
+            async for mode, chunk in self.app.astream(
+                initial_state,
+                config={"configurable": {"on_insight": on_insight}},
+                stream_mode=["updates", "values"]
+            ):
+                if mode == "updates":
+                    for node_name, update in chunk.items():
+                        yield node_name, update or {}
+                else:
+                    final_state = chunk
+            result = self._build_result(final_state)
+            
+        except Exception as e:
+            result = self._error_result(user_query, e)
+            
+        yield "result", result
+    
+    async def analyze_many(self, queries: List[str], max_concurrent: int = 5) -> List[Dict[str, Any]]:
+        semaphore = asyncio.Semaphore(max_concurrent)
+        
+        async def run(user_query: str) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.a_analyze(user_query)
+        
+        return list(await asyncio.gather(*(run(query) for query in queries)))
+    
+    def _initial_state(self, user_query: str) -> EcommerceAnalysisState:
+        # Fail fast instead of spending LLM calls (and retries) on an empty request
+        if not user_query or not user_query.strip():
+            raise ValueError("Empty query: please describe the analysis you need")
+        
+        return EcommerceAnalysisState(
             messages=[HumanMessage(content=user_query)],
             user_query=user_query,
             analysis_type=None,
             table_schemas={},
+            schema_context="",
             generated_sql="",
+            plan_cache_key=None,
             query_results=None,
             insights=[],
             error_count=0,
             last_error=None,
+            last_failed_node=None,
             completed=False
         )
-        
-        try:
-            final_state = self.app.invoke(initial_state)
-            
-            return {
-                "success": final_state.get("completed", False),
-                "user_query": final_state.get("user_query", ""),
-                "analysis_type": final_state.get("analysis_type", ""),
-                "generated_sql": final_state.get("generated_sql", ""),
-                "query_results": final_state.get("query_results", {}),
-                "insights": final_state.get("insights", []),
-                "error_count": final_state.get("error_count", 0),
-                "last_error": final_state.get("last_error")
-            }
-            
-        except Exception as e:
-            logger.error(f"Error during analysis: {e}")
-            return {
-                "success": False,
-                "error": str(e),
-                "user_query": user_query,
-                "insights": [f"Analysis failed due to error: {str(e)}"]
-            }
+    
+    def _build_result(self, final_state: Dict[str, Any]) -> Dict[str, Any]:
+        # error_handler also marks the run completed when it gives up, so only
+        # a run that produced insights counts as a success
+        success = bool(final_state.get("completed") and final_state.get("insights"))
+        result = {
+            "success": success,
+            "user_query": final_state.get("user_query", ""),
+            "analysis_type": final_state.get("analysis_type", ""),
+            "generated_sql": final_state.get("generated_sql", ""),
+            "query_results": final_state.get("query_results", {}),
+            "insights": final_state.get("insights", []),
+            "error_count": final_state.get("error_count", 0),
+            "last_error": final_state.get("last_error")
+        }
+        if not success:
+            result["error"] = final_state.get("last_error") or "Maximum retry attempts reached"
+        return result
+    
+    def _error_result(self, user_query: str, error: Exception) -> Dict[str, Any]:
+        logger.error(f"Error during analysis: {error}")
+        return {
+            "success": False,
+            "error": str(error),
+            "user_query": user_query,
+            "insights": [f"Analysis failed due to error: {str(error)}"]
+        }
     
     def get_schema_info(self, table_name: str = None) -> Dict[str, Any]:
         if table_name:
@@ -143,12 +257,10 @@ class EcommerceAnalysisAgent:
                 logger.error(f"Error getting schema for {table_name}: {e}")
                 return {"error": str(e)}
         else:
-            # Return all table schemas
-            from agent_state import ECOMMERCE_TABLES
-            schemas = {}
-            for table in ECOMMERCE_TABLES.keys():
-                try:
-                    schemas[table] = self.bq_client.get_table_schema(table)
-                except Exception as e:
-                    logger.warning(f"Could not get schema for {table}: {e}")
-            return schemas
\ No newline at end of file
+            # Return all table schemas, fetched together in one query
+            try:
+                schemas = self.bq_client.get_dataset_schema()
+            except Exception as e:
+                logger.error(f"Error getting dataset schema: {e}")
+                return {"error": str(e)}
+            return {table: schemas[table] for table in ECOMMERCE_TABLES.keys() if table in schemas}
\ No newline at end of file